@@ -18,16 +18,23 @@
 #
 # v0.14 JPB 10/11/21 Tidied up for release
 
-import array, time, uctypes, math, random
+import array, time, uctypes, math, random, micropython
+from micropython import const
 import rp_devices as devs, rp_esp32 as esp32
 
-ADC_CHAN = 0
-ADC_PIN  = 26 + ADC_CHAN
-ADC_SAMPLES = 20
-MIN_SAMPLES, MAX_SAMPLES = 10, 1000
-ADC_RATE = 100000
-MIN_RATE, MAX_RATE = 1000, 500000
-DMA_CHAN = 0
+ADC_CHAN = const(0)
+ADC_PIN  = const(26 + ADC_CHAN)
+ADC_SAMPLES = const(20)
+MIN_SAMPLES = const(10)
+MAX_SAMPLES = const(1000)
+ADC_RATE = const(100000)
+MIN_RATE = const(1000)
+MAX_RATE = const(500000)
+ADC_CLK  = const(48000000)
+DMA_CHAN = const(0)
+DMA_CHAN2 = const(1)
+DMA_BUSY = const(1 << 24)
+FCS_LEVEL = const(0xf << 16)
 
 DIRECTORY     = "/"
 INDEX_HTML    = "rpscope.html"
@@ -37,9 +44,37 @@ ICON_ICO      = "favicon.ico"
 
 adc = devs.ADC_DEVICE
 dma_chan = devs.DMA_CHANS[DMA_CHAN]
+dma_chan2 = devs.DMA_CHANS[DMA_CHAN2]
 dma = devs.DMA_DEVICE
+ADC_FCS_ADDR = devs.ADC_BASE + 0x08
 
-parameters = {"nsamples":ADC_SAMPLES, "xrate":ADC_RATE, "simulate":0}
+# Keys are bytes, as the request is parsed without decoding it
+parameters = {b"nsamples":ADC_SAMPLES, b"xrate":ADC_RATE, b"simulate":0}
+
+# Sample buffer, allocated once so DMA address and heap use are fixed
+ADC_BUFF = array.array('H', bytearray(MAX_SAMPLES * 2))
+ADC_BUFF_ADDR = uctypes.addressof(ADC_BUFF)
+
+# Buffer for ASCII sample values (7 bytes per sample, rounded up)
+ASCII_BUFF = bytearray(MAX_SAMPLES * 8)
+
+# Convert raw ADC samples to ASCII voltages separated by CRLF, starting
+# at offset p in the output buffer; return the new offset
+@micropython.viper
+def fmt_samples(buf: ptr16, n: int, out: ptr8, p: int) -> int:
+    for i in range(n):
+        if p:
+            out[p] = 0x0d
+            out[p+1] = 0x0a
+            p += 2
+        mv = (int(buf[i]) * 3300) >> 12
+        out[p]   = 0x30 + mv // 1000
+        out[p+1] = 0x2e
+        out[p+2] = 0x30 + (mv // 100) % 10
+        out[p+3] = 0x30 + (mv // 10) % 10
+        out[p+4] = 0x30 + mv % 10
+        p += 5
+    return p
 
 # Check if file exists
 def file_exists(fname):
@@ -50,23 +85,33 @@ def file_exists(fname):
     except:
         return False
     
-# Get filename & parameters from HTML request
+# Get filename & parameters from HTML request bytes (single-pass index scan)
 def get_fname_params(line, params):
-    fname = ""
-    params["simulate"] = 0
-    parts = line.split()
-    if len(parts) > 1:
-        p = parts[1].partition('?')
-        fname = p[0]
-        query = p[2].split('&')
-        for param in query:
-            p = param.split('=')
-            if len(p) > 1:
-                if p[0] in params:
-                    try:
-                        params[p[0]] = int(p[1].replace("on", "1"));
-                    except:
-                        pass
+    params[b"simulate"] = 0
+    i = line.find(b' ')
+    if i < 0:
+        return ""
+    j = line.find(b' ', i + 1)
+    if j < 0:
+        j = len(line)
+    q = line.find(b'?', i + 1)
+    if q < 0 or q > j:
+        return line[i+1: j].decode()
+    fname = line[i+1: q].decode()
+    n = q + 1
+    while n < j:
+        e = line.find(b'&', n)
+        if e < 0 or e > j:
+            e = j
+        eq = line.find(b'=', n)
+        if n < eq < e:
+            key = line[n: eq]
+            if key in params:
+                try:
+                    params[key] = int(line[eq+1: e].replace(b"on", b"1"))
+                except:
+                    pass
+        n = e + 1
     return fname
 
 # Initialise ADC DMA
@@ -77,7 +122,6 @@ def adc_dma_init():
     pad.PAD_REG = 0
 
     dma.CHAN_ABORT = 0xffff
-    dma_chan.CTRL_TRIG_REG = 0
 
     adc.CS_REG = adc.FCS_REG = 0
     adc.CS.EN = 1
@@ -85,47 +129,85 @@ def adc_dma_init():
     adc.FCS.THRESH = adc.FCS.OVER = adc.FCS.UNDER = 1
     adc.CS.AINSEL = ADC_CHAN
 
-    dma_chan.READ_ADDR_REG = devs.ADC_FIFO_ADDR
-    dma_chan.CTRL_TRIG_REG = 0
-    dma_chan.CTRL_TRIG.CHAIN_TO = DMA_CHAN
-    dma_chan.CTRL_TRIG.INCR_WRITE = dma_chan.CTRL_TRIG.IRQ_QUIET = 1
-    dma_chan.CTRL_TRIG.TREQ_SEL = devs.DREQ_ADC
-    dma_chan.CTRL_TRIG.DATA_SIZE = 1
+    # First channel chains to the second, which chains to itself (no chain)
+    for chan in (dma_chan, dma_chan2):
+        chan.READ_ADDR_REG = devs.ADC_FIFO_ADDR
+        chan.CTRL_TRIG_REG = 0
+        chan.CTRL_TRIG.CHAIN_TO = DMA_CHAN2
+        chan.CTRL_TRIG.INCR_WRITE = chan.CTRL_TRIG.IRQ_QUIET = 1
+        chan.CTRL_TRIG.TREQ_SEL = devs.DREQ_ADC
+        chan.CTRL_TRIG.DATA_SIZE = 1
+
+# Drain the ADC FIFO through raw pointers: a uctypes bitfield access per
+# FIFO entry is far slower than the single-cycle viper register reads
+@micropython.viper
+def flush_fifo(fcs: ptr32, fifo: ptr32):
+    while fcs[0] & FCS_LEVEL:
+        x = fifo[0]
 
 # Discard any data in ADC FIFO
 def flush_adc_fifo():
     dma_chan.CTRL_TRIG.EN = 0
-    while adc.FCS.LEVEL:
-        x = adc.FIFO_REG
+    dma_chan2.CTRL_TRIG.EN = 0
+    flush_fifo(ADC_FCS_ADDR, devs.ADC_FIFO_ADDR)
 
-# Capture ADC samples using DMA
+# Capture ADC samples using DMA: the channels fill half the buffer each,
+# so the first half can be formatted while the second is still filling
 def adc_capture():
     flush_adc_fifo()
-    nsamp = max(MIN_SAMPLES, min(MAX_SAMPLES, parameters["nsamples"]))
-    rate = max(MIN_RATE, min(MAX_RATE, parameters["xrate"]))
-    adc_buff = array.array('H', (0 for _ in range(nsamp)))
-    adc.DIV_REG = (48000000 // rate - 1) << 8
-    dma_chan.WRITE_ADDR_REG = uctypes.addressof(adc_buff)
-    dma_chan.TRANS_COUNT_REG = nsamp
+    nsamp = max(MIN_SAMPLES, min(MAX_SAMPLES, parameters[b"nsamples"]))
+    rate = max(MIN_RATE, min(MAX_RATE, parameters[b"xrate"]))
+    adc.DIV_REG = (ADC_CLK // rate - 1) << 8
+    half = nsamp >> 1
+    dma_chan.WRITE_ADDR_REG = ADC_BUFF_ADDR
+    dma_chan.TRANS_COUNT_REG = half
+    dma_chan2.WRITE_ADDR_REG = ADC_BUFF_ADDR + half * 2
+    dma_chan2.TRANS_COUNT_REG = nsamp - half
+    dma_chan2.AL1_CTRL_REG = dma_chan2.CTRL_TRIG_REG | 1
     dma_chan.CTRL_TRIG.EN = 1
     adc.CS.START_MANY = 1
-    while dma_chan.CTRL_TRIG.BUSY:
-        time.sleep_ms(10)
+    usec = half * 1000000 // rate
+    if usec >= 2000:
+        time.sleep_us(usec)
+    while dma_chan.CTRL_TRIG_REG & DMA_BUSY:
+        pass
+    nbytes = fmt_samples(ADC_BUFF, half, ASCII_BUFF, 0)
+    if usec >= 2000:
+        while dma_chan2.CTRL_TRIG_REG & DMA_BUSY:
+            time.sleep_ms(1)
+    else:
+        while dma_chan2.CTRL_TRIG_REG & DMA_BUSY:
+            pass
     adc.CS.START_MANY = 0
     dma_chan.CTRL_TRIG.EN = 0
-    return "\r\n".join([("%1.3f" % (val*3.3/4096)) for val in adc_buff])
+    dma_chan2.CTRL_TRIG.EN = 0
+    return fmt_samples(memoryview(ADC_BUFF)[half:], nsamp - half, ASCII_BUFF, nbytes)
+
+# Fill buffer with simulated raw samples: Q16 fixed-point sine plus noise
+@micropython.native
+def adc_sim_fill(buff, nsamp):
+    f = nsamp * 65536 // 20
+    s, c = 65536, 0
+    for n in range(0, nsamp):
+        s += (c << 16) // f
+        c -= (s << 16) // f
+        val = ((s + 65536) * (c + 65536)) >> 16
+        val += (random.getrandbits(7) << 16) // 381
+        buff[n] = (val * 1241) >> 16 if val > 0 else 0
 
 # Simulate ADC samples: sine wave plus noise
 def adc_sim():
-    nsamp = parameters["nsamples"]
-    buff = array.array('f', (0 for _ in range(nsamp)))
-    f, s, c = nsamp/20.0, 1.0, 0.0
-    for n in range(0, nsamp):
-        s += c / f
-        c -= s / f
-        val = ((s + 1) * (c + 1)) + random.randint(0, 100) / 300.0
-        buff[n] = val
-    return "\r\n".join([("%1.3f" % val) for val in buff])
+    nsamp = max(MIN_SAMPLES, min(MAX_SAMPLES, parameters[b"nsamples"]))
+    adc_sim_fill(ADC_BUFF, nsamp)
+    return fmt_samples(ADC_BUFF, nsamp, ASCII_BUFF, 0)
+
+# Producer sending formatted samples to client in SPI-sized chunks
+def sample_producer(nbytes):
+    def produce(send):
+        mv = memoryview(ASCII_BUFF)[:nbytes]
+        for n in range(0, nbytes, esp32.MAX_SPI_DLEN):
+            send(mv[n: n+esp32.MAX_SPI_DLEN])
+    return produce
 
 esp = esp32.server_init()
 adc_dma_init()
@@ -134,25 +216,25 @@ while True:
     req = esp.get_http_request()
     if req:
         #print(req)
-        line = req.split("\r")[0]
+        line = req.partition(b"\r")[0]
         fname = get_fname_params(line, parameters)
-        print(line, end="")
         if ICON_ICO in fname:
-            print(": not found")
             esp.put_http_404()
-        elif DATA_CSV in fname:
-            print(": data file")
-            esp.put_http_file(DIRECTORY+DATA_FNAME, "text/csv", esp32.DISABLE_CACHE)
-        elif CAPTURE_CSV in fname:
-            print(": capture CSV")
-            vals = adc_sim() if parameters["simulate"] else adc_capture()
-            esp.put_http_text(vals, "text/csv", esp32.DISABLE_CACHE)
-        elif file_exists(fname):
-            print(": file %s" % fname)            
-            esp.put_http_file(fname)
         else:
-            print(": index file")
-            esp.put_http_file(DIRECTORY+INDEX_HTML)
+            print(line.decode(), end="")
+            if DATA_CSV in fname:
+                print(": data file")
+                esp.put_http_file(DIRECTORY+DATA_CSV, "text/csv", esp32.DISABLE_CACHE)
+            elif CAPTURE_CSV in fname:
+                print(": capture CSV")
+                nbytes = adc_sim() if parameters[b"simulate"] else adc_capture()
+                esp.put_http_stream(nbytes, sample_producer(nbytes), "text/csv", esp32.DISABLE_CACHE)
+            elif file_exists(fname):
+                print(": file %s" % fname)
+                esp.put_http_file(fname)
+            else:
+                print(": index file")
+                esp.put_http_file_cached(DIRECTORY+INDEX_HTML)
         #if parameters:
         #    print("Parameters: " + str(parameters))
     time.sleep_ms(10)
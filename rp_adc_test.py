@@ -42,7 +42,7 @@ dma_chan = devs.DMA_CHANS[DMA_CHAN]
 dma = devs.DMA_DEVICE
 
 adc.FCS.EN = adc.FCS.DREQ_EN = 1
-adc_buff = array.array('H', (0 for _ in range(NSAMPLES)))
+adc_buff = array.array('H', bytearray(NSAMPLES * 2))
 adc.DIV_REG = (48000000 // RATE - 1) << 8
 adc.FCS.THRESH = adc.FCS.OVER = adc.FCS.UNDER = 1
 
@@ -61,11 +61,14 @@ while adc.FCS.LEVEL:
     x = adc.FIFO_REG
     
 adc.CS.START_MANY = 1
+usec = NSAMPLES * 1000000 // RATE
+if usec >= 2000:
+    time.sleep_us(usec)
 while dma_chan.CTRL_TRIG.BUSY:
-    time.sleep_ms(10)
+    pass
 adc.CS.START_MANY = 0
 dma_chan.CTRL_TRIG.EN = 0
-vals = [("%1.3f" % (val*3.3/4096)) for val in adc_buff]
+vals = [("%d.%03d" % divmod((val*3300) >> 12, 1000)) for val in adc_buff]
 print(vals)
 
 # EOF
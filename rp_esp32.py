@@ -22,7 +22,7 @@
 # v0.07 JPB 19/10/21 Added content-type to put_http_text
 # v0.08 JPB 23/10/21 Changed recv_length to use avail_data (was avail_server) 
 
-import os, utime, picowireless, machine
+import os, utime, picowireless, machine, micropython
 from micropython import const
 
 WIFI_SSID = "testnet"
@@ -33,6 +33,9 @@ ADC_SCALE = 3.3 / 65536
 TCP_MODE = const(0)
 HTTP_PORT = const(80)
 MAX_SPI_DLEN = const(128)
+MAX_REQ = const(1024)
+FILE_CACHE_ENTRIES = const(2)
+FILE_CACHE_MAXLEN = const(8192)
 
 DIRECTORY     = "/"
 TEST_FNAME    = "test.html"
@@ -41,13 +44,13 @@ DATA_FNAME    = "data.csv"
 CAPTURE_FNAME = "capture.csv"
 ICON_FNAME    = "favicon.ico"
 
-HTTP_OK = "HTTP/1.1 200 OK\r\n"
-CONTENT_LEN = "Content-Length: %u\r\n"
+HTTP_OK = b"HTTP/1.1 200 OK\r\nContent-Length: "
 CONTENT_TYPE = "Content-type %s\r\n"
 TEST_PAGE = '''<!DOCTYPE html><html>
     <head><style>table, th, td {border: 1px solid black; margin: 5px;}</style></head>
     <body><h2>Pi Pico web server</h2>%s</body></html>'''
-NOT_FOUND = 'HTTP/1.1 404 Not found\r\nContent-Length: 14\r\n\r\nFile not found'
+NOT_FOUND = b'HTTP/1.1 404 Not found\r\nContent-Length: 14\r\n\r\nFile not found'
+URI_TOO_LONG = b'HTTP/1.1 414 URI Too Long\r\nContent-Length: 0\r\n\r\n'
 DISABLE_CACHE = "Cache-Control: no-cache, no-store, must-revalidate\r\n"
 DISABLE_CACHE += "Pragma: no-cache\r\nExpires: 0\r\n"
 HEAD_END = "\r\n"
@@ -56,19 +59,33 @@ HEAD_END = "\r\n"
 # Matching MicroPython functions: nina-fw/main/CommandHandler.cpp
 
 # Wifi status (firmware getConnStatus): see nina-fw/arduino/libraries/WiFi/src/Wifi.h
-status_strs = {0:"idle", 1:"connecting", 2:"scan complete", 3:"connected", 4:"connect failed",
-               5:"connection lost", 6:"disconnected", 255:"no WiFi"}
+status_strs = ("idle", "connecting", "scan complete", "connected", "connect failed",
+               "connection lost", "disconnected")
 STATUS_OK, STATUS_FAIL = 3, 4
+STATUS_NO_WIFI = 255
 
 # Check elapsed msec for timeout
 def mstimeout(start, tout):
     return utime.ticks_ms()-start > tout
 
+# Constant header tails (content-type + extra headers), precomposed as bytes
+hdr_tails = {}
+
+# Build response header block: only the content length is formatted per call
+def http_header(length, content, hdr):
+    tail = hdr_tails.get(content + hdr)
+    if tail is None:
+        tail = hdr_tails[content + hdr] = (HEAD_END + CONTENT_TYPE%content + hdr + HEAD_END).encode()
+    return b"".join((HTTP_OK, b"%u" % length, tail))
+
 # Class for ESP32 WiFi interface
 class ESP32:
     def __init__(self):
         self.last_status = self.server_sock = None
         self.txcount = 0
+        self.pending = 0
+        self._file_cache = {}
+        self._req_buf = bytearray(MAX_REQ)
         picowireless.init()
         picowireless.set_power_mode(0)
 
@@ -86,7 +103,10 @@ class ESP32:
 
     # Display status of WiFi connection
     def disp_wifi_status(self, status):
-        s = status_strs[status] if status in status_strs else str(status)
+        if 0 <= status < len(status_strs):
+            s = status_strs[status]
+        else:
+            s = "no WiFi" if status == STATUS_NO_WIFI else str(status)
         print("WiFi status: %s" % s)
 
     # Check WiFi status, display a change
@@ -119,33 +139,65 @@ class ESP32:
     def recv_data(self, sock):
         return picowireless.get_data_buf(sock)
 
-    # Send block of data to client
+    # Send block of data to client (locals alias the polled functions,
+    # avoiding a module-dict lookup per iteration of the wait loop)
     def send_data(self, sock, data, tout=1000):
+        sent = picowireless.check_data_sent
+        ticks = utime.ticks_ms
         picowireless.send_data(sock, data)
-        startime = utime.ticks_ms()
-        while not picowireless.check_data_sent(sock):
-            if mstimeout(startime, tout):
+        startime = ticks()
+        while not sent(sock):
+            if ticks() - startime > tout:
                 print("Client Tx timeout")
                 self.send_end(sock)
                 return False
         return True
 
+    # Queue block of data to client without waiting for completion
+    def send_data_nowait(self, sock, data):
+        picowireless.send_data(sock, data)
+        self.pending += 1
+
+    # Wait for queued data to finish sending to client
+    def flush_sends(self, sock, tout=1000):
+        if self.pending:
+            self.pending = 0
+            sent = picowireless.check_data_sent
+            ticks = utime.ticks_ms
+            startime = ticks()
+            while not sent(sock):
+                if ticks() - startime > tout:
+                    print("Client Tx timeout")
+                    self.send_end(sock)
+                    return False
+        return True
+
     # Mark end of data sent to client
     def send_end(self, sock):
         picowireless.client_stop(sock)
 
-    # Get HTTP request from client
+    # Get HTTP request from client, rejecting over-long requests
+    @micropython.native
     def get_http_request(self):
         self.client_sock = self.get_client_sock(self.server_sock)
-        request = ""
-        client_dlen = self.recv_length(self.client_sock)
+        recv_len = self.recv_length
+        recv = self.recv_data
+        buf = self._req_buf
+        n = 0
+        client_dlen = recv_len(self.client_sock)
         while self.client_sock != 255 and client_dlen > 0:
             print("Client socket %d len %d: " % (self.client_sock, client_dlen), end="")
-            req = self.recv_data(self.client_sock)
+            req = recv(self.client_sock)
             if req:
-                request += req.decode("utf-8")
-            client_dlen = self.recv_length(self.client_sock)
-        return request
+                if n + len(req) > MAX_REQ:
+                    print("Request too long")
+                    self.send_data(self.client_sock, URI_TOO_LONG)
+                    self.send_end(self.client_sock)
+                    return b""
+                buf[n: n+len(req)] = req
+                n += len(req)
+            client_dlen = recv_len(self.client_sock)
+        return bytes(memoryview(buf)[:n]) if n else b""
 
     def get_http_request2(self, mstout=1000):
         self.client_sock = self.get_client_sock(self.server_sock)
@@ -161,17 +213,23 @@ class ESP32:
                     print("Client Rx timeout")
                     self.send_end(self.client_sock)
                     return None
-            request = req.decode("utf-8")
-            return request
+            return req
         return None
 
     # Split data into blocks, send to client
     def put_data(self, data):
+        if type(data) is str:
+            data = data.encode()
+        mv = memoryview(data)
+        dlen = len(data)
         n = 0
-        while n < len(data):
-            d = data[n: n+MAX_SPI_DLEN]
-            self.send_data(self.client_sock, d)
-            n += len(d)
+        while n < dlen:
+            m = n + MAX_SPI_DLEN
+            if m > dlen:
+                m = dlen
+            self.send_data_nowait(self.client_sock, mv[n: m])
+            n = m
+        self.flush_sends(self.client_sock)
 
     # Send 'not found' error to client
     def put_http_404(self):
@@ -180,13 +238,19 @@ class ESP32:
 
     # Send text response to client
     def put_http_text(self, text, content="text/html", hdr=""):
-        resp = HTTP_OK + CONTENT_LEN%len(text)
-        resp += CONTENT_TYPE%content + hdr + HEAD_END
-        self.put_data(resp)
+        self.put_data(http_header(len(text), content, hdr))
         self.put_data(text)
         self.send_end(self.client_sock)
         self.txcount += 1
 
+    # Send response of known length, with body chunks from producer callback
+    def put_http_stream(self, length, producer, content="text/html", hdr=""):
+        self.put_data(http_header(length, content, hdr))
+        producer(lambda data: self.send_data_nowait(self.client_sock, data))
+        self.flush_sends(self.client_sock)
+        self.send_end(self.client_sock)
+        self.txcount += 1
+
     # Send file from filesystem to client
     def put_http_file(self, fname, content="text/html; charset=utf-8", hdr=""):
         try:
@@ -197,15 +261,38 @@ class ESP32:
             self.put_http_404()
         else:
             flen = os.stat(fname)[6]
-            resp = HTTP_OK + CONTENT_LEN%flen + CONTENT_TYPE%content + hdr + HEAD_END
-            self.send_data(self.client_sock, resp)
+            self.send_data_nowait(self.client_sock, http_header(flen, content, hdr))
             n = 0
             while n < flen:
                 data = f.read(MAX_SPI_DLEN)
-                self.send_data(self.client_sock, data)
+                self.send_data_nowait(self.client_sock, data)
                 n += len(data)
+            self.flush_sends(self.client_sock)
             self.send_end(self.client_sock)
 
+    # Send static file to client, caching small responses in RAM
+    def put_http_file_cached(self, fname, content="text/html; charset=utf-8", hdr=""):
+        try:
+            st = os.stat(fname)
+        except:
+            self.put_http_404()
+            return
+        flen, mtime = st[6], st[8]
+        if flen > FILE_CACHE_MAXLEN:
+            self.put_http_file(fname, content, hdr)
+            return
+        entry = self._file_cache.get(fname)
+        if not entry or entry[0] != mtime:
+            f = open(fname, "rb")
+            body = f.read()
+            f.close()
+            if fname not in self._file_cache and len(self._file_cache) >= FILE_CACHE_ENTRIES:
+                self._file_cache.popitem()
+            entry = self._file_cache[fname] = (mtime, http_header(flen, content, hdr) + body)
+        self.put_data(entry[1])
+        self.send_end(self.client_sock)
+        self.txcount += 1
+
 # Initialise TCP server, return class instance
 def server_init():
     print("Connecting to %s..." % WIFI_SSID)
@@ -229,7 +316,7 @@ if __name__ == "__main__":
     while True:
         req = esp.get_http_request()
         if req:
-            r = req.split("\r")[0]
+            r = req.partition(b"\r")[0].decode()
             print(r, end="")
             if ICON_FNAME in r:
                 print(": not found")
@@ -55,9 +55,10 @@ DISABLE_CACHE += "Pragma: no-cache\r\nExpires: 0\r\n"
 HEAD_END = "\r\n"
 
 # Wifi status (firmware getConnStatus): see nina-fw/arduino/libraries/WiFi/src/Wifi.h
-status_strs = {0:"idle", 1:"connecting", 2:"scan complete", 3:"connected", 4:"connect failed",
-               5:"connection lost", 6:"disconnected", 255:"no WiFi"}
+status_strs = ("idle", "connecting", "scan complete", "connected", "connect failed",
+               "connection lost", "disconnected")
 STATUS_OK, STATUS_FAIL = 3, 4
+STATUS_NO_WIFI = 255
 sock_strs = ("closed", "listen", "syn_sent", "syn_rcvd", "established", "fin_wait_1",
              "fin_wait_2", "close_wait", "closing", "last_ack", "time_wait")
 
@@ -91,7 +92,10 @@ class ESP32:
 
     # Display status of WiFi connection
     def disp_wifi_status(self, status):
-        s = status_strs[status] if status in status_strs else str(status)
+        if 0 <= status < len(status_strs):
+            s = status_strs[status]
+        else:
+            s = "no WiFi" if status == STATUS_NO_WIFI else str(status)
         print("WiFi status: %s" % s)
 
     # Check WiFi status, display a change